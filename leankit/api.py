@@ -1,3 +1,5 @@
+import asyncio
+import concurrent.futures
 import datetime
 import json
 import logging
@@ -6,14 +8,89 @@ import requests
 import time
 from dateutil import parser as date_parser
 from functools import wraps
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 LEANKIT_URL = os.environ['LEANKIT_URL']
 
+_CARD_URL = LEANKIT_URL + "/io/card/"
+_BOARD_URL = LEANKIT_URL + "/io/board/"
+_CARD_UPDATE_URL = LEANKIT_URL + "/kanban/api/card/update"
+_MOVE_CARD_URL = LEANKIT_URL + "/kanban/api/board/{}/MoveCard/{}/lane/{}/position/1"
+_TASK_BOARD_URL = LEANKIT_URL + "/kanban/api/v1/board/{}/card/{}/taskboard"
+_MOVE_TASK_URL = LEANKIT_URL + "/kanban/api/v1/board/{}/move/card/{}/tasks/{}/lane/{}"
+_CARD_HISTORY_URL = LEANKIT_URL + "/kanban/api/card/history/{}/{}"
+_LANE_HISTORY_URL = LEANKIT_URL + "/io/reporting/export/cardpositions.json?boardId={}&limit={}&offset={}"
+
 leankit_session = requests.Session()
 leankit_session.auth = (os.environ['LEANKITUSERNAME'], os.environ['LEANKITPASSWORD'])
-leankit_session.headers = {"Content-Type": "application/json"}
-
-logging.basicConfig(format='{}:%(levelname)s: %(message)s'.format(datetime.datetime.now()), level=logging.WARN)
+leankit_session.headers = {"Content-Type": "application/json",
+                           "Connection": "keep-alive",
+                           "Accept-Encoding": "gzip"}
+
+_RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+_retries = Retry(total=5, backoff_factor=0.3,
+                 status_forcelist=_RETRY_STATUSES,
+                 allowed_methods=frozenset(['GET', 'POST', 'PATCH', 'DELETE']),
+                 respect_retry_after_header=True)
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, pool_block=False,
+                       max_retries=_retries)
+leankit_session.mount('https://', _adapter)
+leankit_session.mount('http://', _adapter)
+
+_HTTP2 = os.environ.get('LEANKIT_HTTP2') == '1'
+_httpx_client = None
+
+
+def _http2_client():
+    global _httpx_client
+    if _httpx_client is None:
+        import httpx
+        # Connection is an HTTP/1.1 hop-by-hop header; forbidden on HTTP/2
+        headers = {k: v for k, v in leankit_session.headers.items()
+                   if k.lower() != 'connection'}
+        _httpx_client = httpx.Client(
+            auth=(os.environ['LEANKITUSERNAME'], os.environ['LEANKITPASSWORD']),
+            headers=headers,
+            transport=httpx.HTTPTransport(
+                http2=True, retries=3,
+                limits=httpx.Limits(max_connections=1, max_keepalive_connections=1)))
+    return _httpx_client
+
+
+def _request(method, url, **kw):
+    if _HTTP2:
+        if 'data' in kw:
+            kw['content'] = kw.pop('data')
+        client = _http2_client()
+        for attempt in range(4):
+            r = client.request(method, url, **kw)
+            if r.status_code not in _RETRY_STATUSES:
+                break
+            time.sleep(0.3 * 2 ** attempt)
+        return r
+    return leankit_session.request(method, url, **kw)
+
+
+logging.basicConfig(format='%(asctime)s:%(levelname)s: %(message)s', level=logging.ERROR)
+
+
+def _dumps(payload):
+    if orjson:
+        return orjson.dumps(payload)
+    return json.dumps(payload)
+
+
+def _loads(response):
+    if orjson:
+        return orjson.loads(response.content)
+    return response.json()
 
 
 def retry(tries=13, delay=1, backoff=2, logger=None):
@@ -41,144 +118,336 @@ def retry(tries=13, delay=1, backoff=2, logger=None):
     return deco_retry
 
 
-@retry(logger=logging)
 def move_card(board_id, card, to_lane):
-    logging.info("move_card: {} lane: {}".format(card["id"], to_lane))
-    leankit_session.post(
-        f"{LEANKIT_URL}/kanban/api/board/{board_id}/MoveCard/{card['id']}/lane/{to_lane}/position/1").raise_for_status()
+    cid = card["id"]
+    logging.info("move_card: %s lane: %s", cid, to_lane)
+    _request('POST', _MOVE_CARD_URL.format(board_id, cid, to_lane)).raise_for_status()
 
 
-@retry(logger=logging)
 def block_card(card, reason):
-    logging.info("block_card: {} reason: {}".format(card["id"], reason))
-    payload = json.dumps({"CardId": card["id"], "IsBlocked": True, "BlockReason": reason or "Not Specified"})
-    leankit_session.post("{}/kanban/api/card/update".format(LEANKIT_URL), data=payload).raise_for_status()
+    cid = card["id"]
+    logging.info("block_card: %s reason: %s", cid, reason)
+    payload = _dumps({"CardId": cid, "IsBlocked": True, "BlockReason": reason or "Not Specified"})
+    _request('POST', _CARD_UPDATE_URL, data=payload).raise_for_status()
+
+
+_ADD_CARD_TMPL = {"index": 1, "blockReason": ""}
 
 
-@retry(logger=logging)
-def add_card(board, lane, title, header="", description="", type_id=None, size=0, url="", tags=[],
+def add_card(board, lane, title, header="", description="", type_id=None, size=0, url="", tags=None,
              external_system_name=""):
-    params = {"boardId": str(board),
+    if tags is None:
+        tags = ()
+    params = {**_ADD_CARD_TMPL,
+              "boardId": str(board),
               "title": title,
               "laneId": str(lane),
               "typeId": str(type_id),
               "description": description,
-              "index": 1,
               "size": size,
-              "blockReason": "",
               "externalLink": {"label": external_system_name, "url": url},
               "tags": tags,
               "customId": header,
               }
-    response = leankit_session.post("{}/io/card/".format(LEANKIT_URL), data=json.dumps(params))
+    response = _request('POST', _CARD_URL, data=_dumps(params))
     if response.status_code == 201:
-        logging.info("added card: {} to lane: {}".format(title, lane))
-        return response.json()['id']
-    logging.error("Error adding card: {}".format(response.json()))
+        logging.info("added card: %s to lane: %s", title, lane)
+        return _loads(response)['id']
+    logging.error("Error adding card: %s", _loads(response))
     response.raise_for_status()
 
 
-@retry(logger=logging)
 def get_card(card_id):
-    return leankit_session.get("{}/io/card/{}".format(LEANKIT_URL, card_id)).json()
+    return _loads(leankit_session.get(_CARD_URL + str(card_id)))
 
 
-@retry(logger=logging)
 def get_children(card_id):
-    return leankit_session.get("{}/io/card/{}/connection/children".format(LEANKIT_URL, card_id)).json()["cards"]
+    return _loads(leankit_session.get(_CARD_URL + str(card_id) + "/connection/children"))["cards"]
+
+
+def _stream_items(response, prefix):
+    """Yield the items of the JSON array at prefix (ijson notation, e.g.
+    'cards.item') without buffering the whole document. Falls back to a
+    one-shot parse when ijson is not installed."""
+    response.raise_for_status()
+    try:
+        import ijson
+    except ImportError:
+        doc = _loads(response)
+        for key in prefix.split('.')[:-1]:
+            doc = doc[key]
+        yield from doc
+        return
+    response.raw.decode_content = True
+    try:
+        yield from ijson.items(response.raw, prefix)
+    finally:
+        response.close()
+
+
+def _pack(**kw):
+    out = {}
+    for k, v in kw.items():
+        if v is None:
+            continue
+        out[k] = ','.join(v) if type(v) is list else v
+    return out
 
 
-@retry(logger=logging)
 def get_cards(board=None, type=None, lane_class_types=None, lanes=None,
               since=None, deleted=False, only=None, search=None, limit=5000, offset=0):
-    params = {}
-    for k, v in locals().items():
-        if not v:
-            continue
-        if isinstance(v, list):
-            params[k] = ','.join(v)
-            continue
-        params[k] = v
-    logging.info("get_cards: params: {}".format(params))
-    return leankit_session.get("{}/io/card/".format(LEANKIT_URL), params=params).json()['cards']
+    params = _pack(board=board, type=type, lane_class_types=lane_class_types, lanes=lanes,
+                   since=since, deleted=deleted, only=only, search=search, limit=limit, offset=offset)
+    logging.info("get_cards: params: %s", params)
+    return _stream_items(leankit_session.get(_CARD_URL, params=params, stream=True), 'cards.item')
+
+
+def iter_all_cards(limit=5000, max_workers=8, **filters):
+    """Yield every card matching filters, paginating automatically.
+
+    The first page is fetched synchronously; once it comes back full,
+    later pages are fetched max_workers at a time and yielded in offset
+    order."""
+    def _page(offset):
+        return list(get_cards(limit=limit, offset=offset, **filters))
+
+    page = _page(0)
+    yield from page
+    offset = limit
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while len(page) == limit:
+            offsets = range(offset, offset + max_workers * limit, limit)
+            for page in pool.map(_page, offsets):
+                yield from page
+                if len(page) < limit:
+                    break
+            offset += max_workers * limit
 
 
-@retry(logger=logging)
 def delete_card(card):
-    logging.warning("delete card {}".format(card["id"]))
-    logging.warning("Uncomment to complete".format(card["id"]))
-    leankit_session.delete("{}/io/card/{}".format(LEANKIT_URL, card['id']))
+    cid = card["id"]
+    logging.warning("delete card %s", cid)
+    logging.warning("Uncomment to complete")
+    _request('DELETE', _CARD_URL + str(cid))
+
+
+_BOARD_TTL = float(os.environ.get('LEANKIT_BOARD_TTL', 300))
+_BOARD_CACHE = {}  # board_id -> (fetched_at, etag, data)
 
 
-@retry(logger=logging)
 def get_board(board_id):
-    url = "{}/io/board/{}".format(LEANKIT_URL, board_id)
-    return leankit_session.get(url).json()
+    cached = _BOARD_CACHE.get(board_id)
+    if cached:
+        fetched_at, etag, data = cached
+        if time.time() - fetched_at < _BOARD_TTL:
+            return data
+        r = leankit_session.get(_BOARD_URL + str(board_id),
+                                headers={'If-None-Match': etag} if etag else None)
+        if r.status_code == 304:
+            _BOARD_CACHE[board_id] = (time.time(), etag, data)
+            return data
+    else:
+        r = leankit_session.get(_BOARD_URL + str(board_id))
+    data = _loads(r)
+    _BOARD_CACHE[board_id] = (time.time(), r.headers.get('ETag'), data)
+    return data
 
 
-@retry(logger=logging)
 def get_task_board(board_id, card_id):
-    url = "{}/kanban/api/v1/board/{}/card/{}/taskboard".format(LEANKIT_URL, board_id, card_id)
-    return leankit_session.get(url).json()['ReplyData'][0]
+    url = _TASK_BOARD_URL.format(board_id, card_id)
+    return _loads(leankit_session.get(url))['ReplyData'][0]
 
 
-@retry(logger=logging)
 def move_task(board_id, card_id, task_id, lane_id):
-    url = "{}/kanban/api/v1/board/{}/move/card/{}/tasks/{}/lane/{}".format(
-        LEANKIT_URL, board_id, card_id, task_id, lane_id)
-    r = leankit_session.post(url)
+    url = _MOVE_TASK_URL.format(board_id, card_id, task_id, lane_id)
+    r = _request('POST', url)
     r.raise_for_status()
 
 
-def reset_card_tasks(board_id, card_id):
-    tb = get_task_board(board_id, card_id)
+_aiohttp_session = None
+
+
+async def _session():
+    global _aiohttp_session
+    if _aiohttp_session is None or _aiohttp_session.closed:
+        import aiohttp
+        _aiohttp_session = aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth(os.environ['LEANKITUSERNAME'], os.environ['LEANKITPASSWORD']),
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+            headers={"Content-Type": "application/json"})
+    return _aiohttp_session
+
+
+async def _close_session():
+    global _aiohttp_session
+    if _aiohttp_session is not None and not _aiohttp_session.closed:
+        await _aiohttp_session.close()
+    _aiohttp_session = None
+
+
+_OFFTHREAD_DECODE_BYTES = 64 * 1024
+
+
+async def _request_async(method, url, data=None, params=None, tries=5, backoff_factor=0.3):
+    """aiohttp request with a bounded retry on transient failures,
+    mirroring the urllib3 Retry policy on the requests adapter."""
+    import aiohttp
+    session = await _session()
+    for attempt in range(tries - 1):
+        try:
+            r = await session.request(method, url, data=data, params=params)
+        except aiohttp.ClientConnectionError:
+            pass
+        else:
+            if r.status not in _RETRY_STATUSES:
+                return r
+            r.release()
+        await asyncio.sleep(backoff_factor * 2 ** attempt)
+    return await session.request(method, url, data=data, params=params)
+
+
+async def _get_json(url, params=None):
+    """Async GET returning the parsed body. Bodies over
+    _OFFTHREAD_DECODE_BYTES are decoded on an executor thread (orjson
+    releases the GIL while parsing), so a large decode overlaps the next
+    fetch instead of stalling the event loop."""
+    r = await _request_async('GET', url, params=params)
+    async with r:
+        r.raise_for_status()
+        data = await r.read()
+    if orjson:
+        if len(data) > _OFFTHREAD_DECODE_BYTES:
+            return await asyncio.get_running_loop().run_in_executor(None, orjson.loads, data)
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+async def get_board_async(board_id):
+    return await _get_json(_BOARD_URL + str(board_id))
+
+
+async def lane_history_async(board_id, limit=1000, offset=0):
+    return await _get_json(_LANE_HISTORY_URL.format(board_id, limit, offset))
+
+
+async def get_task_board_async(board_id, card_id):
+    return (await _get_json(_TASK_BOARD_URL.format(board_id, card_id)))['ReplyData'][0]
+
+
+async def move_task_async(board_id, card_id, task_id, lane_id):
+    url = _MOVE_TASK_URL.format(board_id, card_id, task_id, lane_id)
+    r = await _request_async('POST', url)
+    async with r:
+        r.raise_for_status()
+
+
+async def change_card_type_async(card_id, card_type):
+    r = await _request_async('PATCH', _CARD_URL + str(card_id),
+                             data=_dumps([{"op": "replace", "path": "/typeId", "value": str(card_type)}]))
+    async with r:
+        if r.status == 200:
+            logging.info("Changed card %s type to %s", card_id, card_type)
+        else:
+            logging.error(await r.text())
+
+
+async def reset_card_tasks_async(board_id, card_id):
+    tb = await get_task_board_async(board_id, card_id)
     if not tb:
         return
-    tasks = []
     backlog_lane_id = tb['Lanes'][0]['Id']
-    for l in tb['Lanes']:
-        tasks.extend(l['Cards'])
-    for t in tasks:
-        move_task(board_id, card_id, t['Id'], backlog_lane_id)
+    tasks = [t for l in tb['Lanes'] for t in l['Cards']]
+    _move = move_task_async
+    await asyncio.gather(*[_move(board_id, card_id, t['Id'], backlog_lane_id) for t in tasks])
 
 
-@retry(logger=logging)
-def update_header(card_id, title):
-    logging.info("update header: {}  title: {}".format(card_id, title))
-    r = leankit_session.patch("{}/io/card/{}".format(LEANKIT_URL, card_id),
-                              data=json.dumps([{"op": "replace", "path": "/customId", "value": str(title)}]))
+def reset_card_tasks(board_id, card_id):
+    try:
+        import aiohttp  # noqa: F401
+    except ImportError:
+        tb = get_task_board(board_id, card_id)
+        if not tb:
+            return
+        backlog_lane_id = tb['Lanes'][0]['Id']
+        for t in [t for l in tb['Lanes'] for t in l['Cards']]:
+            move_task(board_id, card_id, t['Id'], backlog_lane_id)
+        return
+
+    async def _run():
+        try:
+            await reset_card_tasks_async(board_id, card_id)
+        finally:
+            await _close_session()
+    asyncio.run(_run())
+
+
+def patch_card(card_id, *ops):
+    """Apply one or more JSON-Patch ops to a card in a single PATCH.
+
+    Each op is an (op, path, value) tuple; 'remove' ops may omit the
+    value. Batching related updates here costs one round trip instead of
+    one per field."""
+    body = []
+    for op in ops:
+        doc = {"op": op[0], "path": op[1]}
+        if len(op) > 2:
+            doc["value"] = op[2]
+        body.append(doc)
+    r = _request('PATCH', _CARD_URL + str(card_id), data=_dumps(body))
     r.raise_for_status()
+    return r
+
+
+class card_patch:
+    """Collect patch ops for one card and flush them as a single PATCH
+    on exit:
+
+        with card_patch(card_id) as p:
+            p.replace('/customId', header)
+            p.replace('/plannedFinish', date)
+    """
+
+    def __init__(self, card_id):
+        self.card_id = card_id
+        self.ops = []
+
+    def replace(self, path, value):
+        self.ops.append(("replace", path, value))
+
+    def remove(self, path):
+        self.ops.append(("remove", path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and self.ops:
+            patch_card(self.card_id, *self.ops)
+
+
+def update_header(card_id, title):
+    logging.info("update header: %s  title: %s", card_id, title)
+    patch_card(card_id, ("replace", "/customId", title))
 
 
-@retry(logger=logging)
 def update_custom_field(card_id, path, value):
-    logging.info("update custom field:\nid:{}\npath:{}\nvalue:{}".format(card_id, path, value))
-    r = leankit_session.patch("{}/io/card/{}".format(LEANKIT_URL, card_id),
-                              data=json.dumps([{"op": "replace", "path": path, "value": value}]))
-    r.raise_for_status()
+    logging.info("update custom field:\nid:%s\npath:%s\nvalue:%s", card_id, path, value)
+    patch_card(card_id, ("replace", path, value))
 
 
-@retry(logger=logging)
 def update_planned_finish(card_id, date):
     """date: yyyy-mm-dd """
-    logging.info("update planned finish: {}  date: {}".format(card_id, date))
-    r = leankit_session.patch("{}/io/card/{}".format(LEANKIT_URL, card_id),
-                              data=json.dumps([{"op": "replace", "path": "/plannedFinish", "value": str(date)}]))
-    r.raise_for_status()
+    logging.info("update planned finish: %s  date: %s", card_id, date)
+    patch_card(card_id, ("replace", "/plannedFinish", date))
 
 
-@retry(logger=logging)
 def change_card_type(card_id, card_type):
     """
     :param card_id: Int
     :param card_type: Int or str: card type id
     """
-    r = leankit_session.patch("{}/io/card/{}".format(LEANKIT_URL, card_id),
-                              data=json.dumps([{"op": "replace", "path": "/typeId", "value": str(card_type)}]))
-    if r.status_code == 200:
-        logging.info("Changed card {} type to {}".format(card_id, card_type))
-    else:
-        logging.error(r.json())
+    patch_card(card_id, ("replace", "/typeId", str(card_type)))
+    logging.info("Changed card %s type to %s", card_id, card_type)
 
     # from leankit.api import *
     # excards = get_cards(board=30502076986646, type=30502076993718)
@@ -197,22 +466,69 @@ def is_card_completed_recently(card, days_ago=30):
     return (datetime.datetime.today() - date_completed).days < days_ago
 
 
-@retry(logger=logging)
+def filter_recent(cards, days_ago=30):
+    """Batch version of is_card_completed_recently: return the cards whose
+    actualFinish is within the last days_ago days. Cards without an
+    actualFinish are dropped. Uses numpy's vectorized date parsing when
+    available, falling back to the per-card dateutil check otherwise."""
+    cards = list(cards)
+    try:
+        import numpy as np
+    except ImportError:
+        return [c for c in cards if is_card_completed_recently(c, days_ago)]
+    ts = np.array([(c['actualFinish'] or '')[:19] for c in cards], dtype='datetime64[s]')
+    cutoff = np.datetime64(datetime.datetime.utcnow()) - np.timedelta64(days_ago, 'D')
+    mask = ts >= cutoff
+    return [c for c, m in zip(cards, mask) if m]
+
+
 def remove_planned_finish(card_id):
-    logging.info("remove planned finish: {}".format(card_id))
-    r = leankit_session.patch("{}/io/card/{}".format(LEANKIT_URL, card_id),
-                              data=json.dumps([{"op": "remove", "path": "/plannedFinish"}]))
-    r.raise_for_status()
+    logging.info("remove planned finish: %s", card_id)
+    patch_card(card_id, ("remove", "/plannedFinish"))
 
 
-@retry(logger=logging)
 def card_history(board_id, card_id):
-    return leankit_session.get("{}/kanban/api/card/history/{}/{}".format(
-        LEANKIT_URL, board_id, card_id)).json()["ReplyData"][0]
+    return _loads(leankit_session.get(_CARD_HISTORY_URL.format(board_id, card_id)))["ReplyData"][0]
 
 
-@retry(logger=logging)
 def lane_history(board_id, limit=1000, offset=0):
-    return leankit_session.get(
-        '{}/io/reporting/export/cardpositions.json?boardId={}&limit={}&offset={}'.format(LEANKIT_URL, board_id, limit,
-                                                                                         offset)).json()
+    return _loads(leankit_session.get(_LANE_HISTORY_URL.format(board_id, limit, offset)))
+
+
+def _history_records(page):
+    """Pull the record array out of a lane_history page, whether the
+    export is a bare array or an object wrapping one."""
+    if type(page) is list:
+        return page
+    for v in page.values():
+        if type(v) is list:
+            return v
+    return []
+
+
+def iter_lane_history(board_id, limit=1000, max_workers=8):
+    """Yield lane_history pages for board_id, paginating automatically.
+
+    The first page is fetched synchronously; once it comes back full,
+    later pages are fetched max_workers at a time and yielded in offset
+    order. Stops at the first empty or short page."""
+    def _page(offset):
+        return lane_history(board_id, limit, offset)
+
+    page = _page(0)
+    records = _history_records(page)
+    if not records:
+        return
+    yield page
+    offset = limit
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while len(records) == limit:
+            offsets = range(offset, offset + max_workers * limit, limit)
+            for page in pool.map(_page, offsets):
+                records = _history_records(page)
+                if not records:
+                    return
+                yield page
+                if len(records) < limit:
+                    return
+            offset += max_workers * limit
@@ -16,5 +16,5 @@ setuptools.setup(
     },
     license='MIT',
     packages=['leankit'],
-    install_requires=['requests', 'python-dateutil'],
+    install_requires=['requests', 'python-dateutil', 'orjson'],
 )